@@ -2,19 +2,26 @@ import asyncio
 import contextlib
 import html
 import logging
+import logging.handlers
 import os
+import pickle
+import queue
+import random
 import tempfile
-from typing import Any, Dict, List, Optional
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import json
 import time
-import requests
 import httpx
+import aiosqlite
+import orjson
 from dotenv import load_dotenv
 from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     KeyboardButton,
+    Message,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     Update,
@@ -24,14 +31,15 @@ from telegram.constants import ChatAction, ParseMode
 from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     MessageHandler,
-    PicklePersistence,
+    PersistenceInput,
     filters,
 )
-from telegram.error import RetryAfter
+from telegram.error import NetworkError, RetryAfter
 
 load_dotenv()
 
@@ -43,11 +51,34 @@ DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gpt-4o-mini")
 # silent login (the web app posts initData → backend /auth/telegram/webapp).
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://salom-ai.uz")
 REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "30"))
+# User state lives in SQLite; STATE_FILE is the legacy pickle, imported once.
+STATE_DB = os.getenv("STATE_DB", "bot_state.sqlite3")
 STATE_FILE = os.getenv("STATE_FILE", "bot_state.pickle")
+# Seconds to share one /chat/models response across all users. Off (0) by
+# default because the backend may filter the list by the user's plan.
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", "0"))
+# Seconds to reuse a user's /subscriptions/current and /cards responses. Off
+# (0) by default: Click/Payme payments complete outside the bot.
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "0"))
+# Seconds between persistence flushes; changed users are written in batches.
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "60"))
 
 if not TELEGRAM_TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN is not set. Add it to your environment or .env file.")
 
+# Shared backend client: one keep-alive pool for every API call instead of a
+# fresh TCP/TLS connection (and a worker thread) per request. HTTP/2 lets
+# concurrent calls share a connection when the backend negotiates it.
+HTTP = httpx.AsyncClient(
+    base_url=BACKEND_URL,
+    timeout=REQUEST_TIMEOUT,
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60.0),
+)
+# Cap on in-flight api_request calls so an update burst queues here instead
+# of piling onto a slow backend.
+_API_SEM = asyncio.Semaphore(64)
+
 # Logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -57,7 +88,12 @@ logger = logging.getLogger("salom_ai_bot")
 LOG_FILE = os.getenv("LOG_FILE", "bot.log")
 file_handler = logging.FileHandler(LOG_FILE)
 file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-logger.addHandler(file_handler)
+# Log calls only enqueue; a background thread does the file writes so error
+# bursts never block the event loop on disk I/O.
+log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+log_listener.start()
 
 # Constants for Menu
 BTN_NEW_CHAT = "💬 Yangi chat"
@@ -82,26 +118,54 @@ USER_DEFAULTS = {
     "pending_card_number": None,
     "pending_request_id": None,
     "pending_phone_hint": None,
+    "phone_verified": False,
+    "device_registered": False,
 }
+# Bump when USER_DEFAULTS gains keys so stored states get backfilled once.
+STATE_VERSION = 1
 
 
 # --- State helpers --------------------------------------------------------- #
 def get_state(context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
     """Return user state with defaults applied."""
-    state = context.user_data.setdefault("state", {})
-    for key, value in USER_DEFAULTS.items():
-        if key not in state:
-            state[key] = value.copy() if isinstance(value, list) else value
+    state = context.user_data.get("state")
+    if state is None or state.get("_v") != STATE_VERSION:
+        # Defaults are merged only on first use or after a version bump;
+        # values already stored for the user win over the defaults.
+        state = {**USER_DEFAULTS, "attachments": [], **(state or {}), "_v": STATE_VERSION}
+        context.user_data["state"] = state
     return state
 
 
-def build_url(path: str) -> str:
-    if not path.startswith("/"):
-        path = f"/{path}"
-    return f"{BACKEND_URL}{path}"
+# --- API helpers ----------------------------------------------------------- #
+class ApiError(RuntimeError):
+    """Failed backend call; the JSON body is parsed once, when raised.
+
+    `status` is the HTTP status code, or 0 when no response arrived at all
+    (connection error, timeout).
+    """
+
+    def __init__(self, status: int, text: str):
+        super().__init__(f"{status}: {text}")
+        self.status = status
+        self.text = text
+        try:
+            body = orjson.loads(text) if text else None
+        except orjson.JSONDecodeError:
+            body = None
+        self.body: Optional[dict] = body if isinstance(body, dict) else None
+
+    @property
+    def detail(self) -> Any:
+        """The `detail` field: a plain message or a {"code", "message"} dict."""
+        return self.body.get("detail") if self.body else None
+
+    @property
+    def code(self) -> Optional[str]:
+        detail = self.detail
+        return detail.get("code") if isinstance(detail, dict) else None
 
 
-# --- API helpers ----------------------------------------------------------- #
 async def authenticate_user(
     telegram_id: int, first_name: Optional[str], username: Optional[str], state: Dict[str, Any]
 ) -> bool:
@@ -112,13 +176,10 @@ async def authenticate_user(
         "username": username,
     }
 
-    def _request():
-        resp = requests.post(build_url("/auth/telegram"), json=payload, timeout=REQUEST_TIMEOUT)
-        resp.raise_for_status()
-        return resp.json()
-
     try:
-        data = await asyncio.to_thread(_request)
+        resp = await HTTP.post("/auth/telegram", json=payload)
+        resp.raise_for_status()
+        data = resp.json()
         state["access_token"] = data["access_token"]
         state["refresh_token"] = data.get("refresh_token")
         return True
@@ -127,28 +188,39 @@ async def authenticate_user(
         return False
 
 
-async def refresh_tokens(state: Dict[str, Any]) -> bool:
-    if not state.get("refresh_token"):
-        return False
+# refresh_token -> in-flight /auth/refresh, so concurrent 401s for one user
+# share a single call. Kept out of the user state, which is persisted as JSON.
+_REFRESHES: Dict[str, "asyncio.Task[Optional[Tuple[str, str]]]"] = {}
 
-    def _request():
-        resp = requests.post(
-            build_url("/auth/refresh"),
-            json={"refresh_token": state["refresh_token"]},
-            timeout=REQUEST_TIMEOUT,
-        )
-        resp.raise_for_status()
-        return resp.json()
 
+async def _refresh(refresh_token: str) -> Optional[Tuple[str, str]]:
     try:
-        data = await asyncio.to_thread(_request)
-        state["access_token"] = data["access_token"]
-        state["refresh_token"] = data.get("refresh_token", state.get("refresh_token"))
-        return True
+        resp = await HTTP.post("/auth/refresh", json={"refresh_token": refresh_token})
+        resp.raise_for_status()
+        data = resp.json()
+        return data["access_token"], data.get("refresh_token", refresh_token)
     except Exception:
         logger.warning("Refresh token failed; user will be re-authenticated.")
+        return None
+    finally:
+        _REFRESHES.pop(refresh_token, None)
+
+
+async def refresh_tokens(state: Dict[str, Any]) -> bool:
+    refresh_token = state.get("refresh_token")
+    if not refresh_token:
+        return False
+
+    task = _REFRESHES.get(refresh_token)
+    if task is None:
+        task = _REFRESHES[refresh_token] = asyncio.create_task(_refresh(refresh_token))
+    # Shielded: one caller being cancelled must not cancel the others' refresh.
+    tokens = await asyncio.shield(task)
+    if tokens is None:
         state["access_token"] = None
         return False
+    state["access_token"], state["refresh_token"] = tokens
+    return True
 
 
 async def api_request(
@@ -162,79 +234,74 @@ async def api_request(
     expect_json: bool = True,
 ) -> Any:
     """Perform an API request with automatic refresh on 401."""
-    url = build_url(path)
 
-    def _request(token: str):
+    # httpx encodes `json=` with the stdlib; orjson is several times faster.
+    content = orjson.dumps(json_body) if json_body is not None else None
+
+    async def _request(token: str) -> httpx.Response:
         headers = {}
+        if content is not None:
+            headers["Content-Type"] = "application/json"
         if token:
             headers["Authorization"] = f"Bearer {token}"
-        resp = requests.request(
-            method,
-            url,
-            json=json_body,
-            params=params,
-            files=files,
-            headers=headers,
-            timeout=REQUEST_TIMEOUT,
-        )
-        return resp
-
-    resp = await asyncio.to_thread(_request, state.get("access_token"))
-    if resp.status_code == 401 and await refresh_tokens(state):
-        resp = await asyncio.to_thread(_request, state.get("access_token"))
+        try:
+            async with _API_SEM:
+                return await HTTP.request(
+                    method,
+                    path,
+                    content=content,
+                    params=params,
+                    files=files,
+                    headers=headers,
+                )
+        except httpx.RequestError as exc:
+            raise ApiError(0, f"{type(exc).__name__}: {exc}") from exc
+
+    resp = await _request(state.get("access_token"))
+    if resp.status_code == 401:
+        # Session changed under us: re-run the phone/device checks next time.
+        state["phone_verified"] = False
+        state["device_registered"] = False
+        if await refresh_tokens(state):
+            resp = await _request(state.get("access_token"))
 
-    if not resp.ok:
-        raise RuntimeError(f"{resp.status_code}: {resp.text}")
+    if not resp.is_success:
+        raise ApiError(resp.status_code, resp.text)
 
-    return resp.json() if expect_json else resp
+    return orjson.loads(resp.content) if expect_json else resp
 
 
 def _extract_api_error(exc: Exception) -> str:
-    """Extract human-readable error from API RuntimeError ('status: json_body')."""
-    msg = str(exc)
-    # RuntimeError format: "400: {"detail":"Card tokenization failed: ..."}"
-    if ": " in msg:
-        json_part = msg.split(": ", 1)[1]
-        try:
-            data = json.loads(json_part)
-            if isinstance(data, dict) and "detail" in data:
-                detail = data["detail"]
-                if isinstance(detail, dict):
-                    return detail.get("message", str(detail))
-                return detail
-        except (json.JSONDecodeError, ValueError):
-            pass
-    return msg
+    """Extract human-readable error from an ApiError's `detail`."""
+    if isinstance(exc, ApiError):
+        detail = exc.detail
+        if isinstance(detail, dict):
+            return detail.get("message", str(detail))
+        if detail is not None:
+            return detail
+    return str(exc)
 
 
 def _is_limit_exceeded(exc: Exception) -> bool:
     """Check if an API error is a LIMIT_EXCEEDED response."""
-    msg = str(exc)
-    if ": " in msg:
-        json_part = msg.split(": ", 1)[1]
-        try:
-            data = json.loads(json_part)
-            if isinstance(data, dict):
-                detail = data.get("detail")
-                if isinstance(detail, dict) and detail.get("code") == "LIMIT_EXCEEDED":
-                    return True
-        except (json.JSONDecodeError, ValueError):
-            pass
-    return False
+    return isinstance(exc, ApiError) and exc.code == "LIMIT_EXCEEDED"
 
 
 # --- UI helpers ------------------------------------------------------------ #
-def get_main_menu() -> ReplyKeyboardMarkup:
-    # First row opens the full Salom AI Mini App (presentations, files, images,
-    # voice — the whole web app) right inside Telegram, with silent login.
-    keyboard = [
+# The main keyboard never changes, so it is built once and shared by every reply.
+# First row opens the full Salom AI Mini App (presentations, files, images,
+# voice — the whole web app) right inside Telegram, with silent login.
+MAIN_MENU = ReplyKeyboardMarkup(
+    [
         [KeyboardButton(BTN_WEBAPP, web_app=WebAppInfo(url=WEBAPP_URL))],
         [KeyboardButton(BTN_NEW_CHAT), KeyboardButton(BTN_IMAGE)],
         [KeyboardButton(BTN_HISTORY), KeyboardButton(BTN_MODEL)],
         [KeyboardButton(BTN_SETTINGS), KeyboardButton(BTN_SUBSCRIBE)],
         [KeyboardButton(BTN_FEEDBACK), KeyboardButton(BTN_HELP)],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, is_persistent=True)
+    ],
+    resize_keyboard=True,
+    is_persistent=True,
+)
 
 
 def webapp_inline_kb(label: str = "🚀 Ilovani ochish") -> InlineKeyboardMarkup:
@@ -262,6 +329,120 @@ def fire(state: Dict[str, Any], name: str, props: Optional[dict] = None) -> None
         pass
 
 
+class TelegramLimiter:
+    """Token buckets in front of outbound Telegram calls.
+
+    Telegram allows about 30 messages per second bot-wide and about one per
+    second in a single chat (short bursts are tolerated). Waiting here is
+    cheaper than being throttled with RetryAfter.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_tokens = global_rate
+        self._global_stamp = time.monotonic()
+        self._chat_tokens: Dict[int, Tuple[float, float]] = {}  # chat_id -> (tokens, stamp)
+
+    def _take(self, chat_id: int) -> float:
+        """Consume one token from both buckets, or return the seconds to wait."""
+        now = time.monotonic()
+        self._global_tokens = min(
+            self.global_rate, self._global_tokens + (now - self._global_stamp) * self.global_rate
+        )
+        self._global_stamp = now
+        tokens, stamp = self._chat_tokens.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - stamp) * self.chat_rate)
+
+        wait = max((1 - self._global_tokens) / self.global_rate, (1 - tokens) / self.chat_rate)
+        if wait <= 0:
+            self._global_tokens -= 1
+            tokens -= 1
+        self._chat_tokens[chat_id] = (tokens, now)
+        if len(self._chat_tokens) > 4096:
+            # Forget chats whose bucket has refilled completely.
+            full_after = self.chat_burst / self.chat_rate
+            self._chat_tokens = {
+                cid: entry for cid, entry in self._chat_tokens.items() if now - entry[1] < full_after
+            }
+        return wait
+
+    def try_take(self, chat_id: int) -> bool:
+        """Consume a token if one is free right now; never waits."""
+        return self._take(chat_id) <= 0
+
+    async def acquire(self, chat_id: int) -> None:
+        # _take never awaits, so the bucket update is atomic on the event loop.
+        while True:
+            wait = self._take(chat_id)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+
+TELEGRAM_LIMITER = TelegramLimiter()
+TELEGRAM_MAX_RETRIES = 4
+# Updates are handled one at a time, so a handler sleeping on RetryAfter
+# stalls every user; give up once the pauses would add up to more than this.
+TELEGRAM_MAX_RETRY_WAIT = 10.0
+
+
+async def telegram_call(
+    coro_factory: Callable[[], Awaitable[Any]],
+    *,
+    chat_id: Optional[int] = None,
+    max_retries: int = TELEGRAM_MAX_RETRIES,
+    idempotent: bool = False,
+) -> Any:
+    """Run an outbound Telegram call, retrying flood control and network errors.
+
+    `coro_factory` is called once per attempt. RetryAfter waits the pause
+    Telegram asked for, up to TELEGRAM_MAX_RETRY_WAIT in total. Timeouts and
+    connection errors are only retried for `idempotent` calls (edits, callback
+    answers): a timed-out send has often been delivered already, and repeating
+    it would post a duplicate. Those back off exponentially (capped at 60 s).
+    Both get a little jitter so throttled chats don't retry in lockstep. With
+    `chat_id` every attempt goes through TELEGRAM_LIMITER.
+    """
+    attempt = 0
+    waited = 0.0
+    while True:
+        if chat_id is not None:
+            await TELEGRAM_LIMITER.acquire(chat_id)
+        try:
+            return await coro_factory()
+        except RetryAfter as e:
+            if attempt >= max_retries or waited + e.retry_after > TELEGRAM_MAX_RETRY_WAIT:
+                raise
+            delay = e.retry_after + random.uniform(0, 0.25)
+        except BadRequest:
+            # A NetworkError subclass, but retrying won't change the answer.
+            raise
+        except NetworkError:  # includes TimedOut
+            if not idempotent or attempt >= max_retries:
+                raise
+            delay = min(60.0, 0.5 * 2**attempt) + random.uniform(0, 0.25)
+        attempt += 1
+        waited += delay
+        await asyncio.sleep(delay)
+
+
+async def limited_edit_message_text(
+    bot: Any,
+    chat_id: int,
+    message_id: int,
+    text: str,
+    **kwargs: Any,
+) -> Any:
+    """`bot.edit_message_text` through telegram_call, waiting for a limiter token."""
+    return await telegram_call(
+        lambda: bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs),
+        chat_id=chat_id,
+        idempotent=True,
+    )
+
+
 async def answer(
     update: Update,
     text: str,
@@ -271,67 +452,156 @@ async def answer(
 ) -> None:
     """Reply or edit the message depending on update type."""
     parse_mode = ParseMode.HTML if html_mode else None
+    chat_id = update.effective_chat.id if update.effective_chat else None
     if update.callback_query:
         query = update.callback_query
         with contextlib.suppress(BadRequest):
             # If we are answering a callback query, we usually want to edit the message
             # But if markup is ReplyKeyboardMarkup, we must send a new message
             if isinstance(markup, ReplyKeyboardMarkup):
-                await query.message.reply_text(text, reply_markup=markup, parse_mode=parse_mode)
+                await telegram_call(
+                    lambda: query.message.reply_text(text, reply_markup=markup, parse_mode=parse_mode),
+                    chat_id=chat_id,
+                )
             else:
-                await query.edit_message_text(text, reply_markup=markup, parse_mode=parse_mode)
-            await query.answer()
+                await telegram_call(
+                    lambda: query.edit_message_text(text, reply_markup=markup, parse_mode=parse_mode),
+                    chat_id=chat_id,
+                    idempotent=True,
+                )
+            await telegram_call(query.answer, idempotent=True)
             return
     elif update.message:
-        await update.message.reply_text(text, reply_markup=markup, parse_mode=parse_mode)
+        await telegram_call(
+            lambda: update.message.reply_text(text, reply_markup=markup, parse_mode=parse_mode),
+            chat_id=chat_id,
+        )
+
+
+async def _send_typing(update: Update) -> None:
+    with contextlib.suppress(Exception):
+        await update.effective_chat.send_chat_action(ChatAction.TYPING)
+
+
+async def with_typing(update: Update, awaitable: Awaitable[Any]) -> Any:
+    """Await a slow backend call while a "typing…" indicator is sent alongside it."""
+    task = asyncio.create_task(_send_typing(update))
+    try:
+        return await awaitable
+    finally:
+        task.cancel()
+
+
+# Backend calls that finish within this many seconds get a single reply;
+# slower ones first show a "⏳ ..." status that is then edited with the result.
+STATUS_MESSAGE_DELAY = 0.7
+
+
+async def deferred_status(update: Update, task: "asyncio.Future[Any]", text: str) -> Optional[Message]:
+    """Post `text` as a status message only if `task` is still running after STATUS_MESSAGE_DELAY.
+
+    Never raises: the caller must go on to await `task` and report its real
+    outcome (e.g. a card charge), so a failed status send only returns None.
+    """
+    done, _ = await asyncio.wait({task}, timeout=STATUS_MESSAGE_DELAY)
+    if done:
+        return None
+    try:
+        return await telegram_call(lambda: update.message.reply_text(text), chat_id=update.effective_chat.id)
+    except Exception as exc:
+        logger.warning("Status message failed: %s", exc)
+        return None
+
+
+async def finish_status(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    status_msg: Optional[Message],
+    text: str,
+    **kwargs: Any,
+) -> None:
+    """Edit the status message with the final text, or reply if none was posted."""
+    if status_msg is None:
+        await telegram_call(lambda: update.message.reply_text(text, **kwargs), chat_id=update.effective_chat.id)
+        return
+    await limited_edit_message_text(context.bot, update.effective_chat.id, status_msg.message_id, text, **kwargs)
 
 
 def trim(text: str, limit: int = 3500) -> str:
     return text if len(text) <= limit else text[:limit] + "..."
 
 
+async def _none() -> None:
+    """Awaitable placeholder for an optional slot in asyncio.gather."""
+    return None
+
+
 # --- Core flows ------------------------------------------------------------ #
 async def ensure_ready(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Dict[str, Any]:
     """Ensure user is authenticated and state is initialized."""
     state = get_state(context)
-    if state.get("access_token"):
+    # Hot path: once both checks have run, handlers start with zero API calls.
+    if state.get("access_token") and state.get("phone_verified") and state.get("device_registered"):
         return state
 
-    user = update.effective_user
-    if not user:
-        raise RuntimeError("No user information available.")
-
-    ok = await authenticate_user(user.id, user.first_name, user.username, state)
-    if not ok:
-        await answer(update, "⚠️ Autentifikatsiya xatosi. Iltimos /start ni bosing.")
-        raise RuntimeError("Auth failed")
+    if not state.get("access_token"):
+        user = update.effective_user
+        if not user:
+            raise RuntimeError("No user information available.")
+
+        ok = await authenticate_user(user.id, user.first_name, user.username, state)
+        if not ok:
+            await answer(update, "⚠️ Autentifikatsiya xatosi. Iltimos /start ni bosing.")
+            raise RuntimeError("Auth failed")
+
+    need_phone = not state.get("phone_verified")
+    need_device = not state.get("device_registered")
+
+    # The phone check and the notification registration are independent, so
+    # overlap them; a check that is already cached resolves to None.
+    # We use the chat ID as the token for Telegram platform
+    device_payload = {"token": str(update.effective_chat.id), "platform": "telegram"}
+    me, device = await asyncio.gather(
+        api_request("get", "/auth/me", state) if need_phone else _none(),
+        api_request("post", "/notifications/device", state, json_body=device_payload) if need_device else _none(),
+        return_exceptions=True,
+    )
 
     # Enforce phone number check for ALL users (new and existing)
     # We check via API if user has phone.
-    try:
-        me = await api_request("get", "/auth/me", state)
-        has_phone = bool(me.get("phone_e164"))
-    except Exception:
-        has_phone = False
+    if need_phone and isinstance(me, Exception):
+        # A backend hiccup is not proof the phone is missing; leave the flag
+        # unset so the next update checks again, and carry on.
+        logger.warning("Phone check failed: %s", me)
+    elif need_phone:
+        if not (isinstance(me, dict) and me.get("phone_e164")):
+            # Request phone number
+            btn = KeyboardButton("📱 Telefon raqamni yuborish", request_contact=True)
+            kb = ReplyKeyboardMarkup([[btn]], resize_keyboard=True, one_time_keyboard=True)
+            await answer(update, "Salom! Botdan to'liq foydalanish uchun telefon raqamingizni yuboring.", markup=kb)
+            # Stop processing current update
+            raise RuntimeError("Phone required")
+        state["phone_verified"] = True
+
+    # Register for notifications (link Chat ID). Notifications are optional,
+    # so one attempt per session is enough even if it failed.
+    if need_device:
+        if isinstance(device, Exception):
+            logger.warning("Notification registration failed: %s", device)
+        state["device_registered"] = True
 
-    if not has_phone:
-        # Request phone number
-        btn = KeyboardButton("📱 Telefon raqamni yuborish", request_contact=True)
-        kb = ReplyKeyboardMarkup([[btn]], resize_keyboard=True, one_time_keyboard=True)
-        await answer(update, "Salom! Botdan to'liq foydalanish uchun telefon raqamingizni yuboring.", markup=kb)
-        # Stop processing current update
-        raise RuntimeError("Phone required")
+    return state
 
-    # Register for notifications (link Chat ID)
+
+async def _payment_status(state: Dict[str, Any], arg: str) -> Optional[str]:
+    """Resolve a `payment_<id>` deep link to its status, or None on failure."""
     try:
-        # We use the chat ID as the token for Telegram platform
-        device_payload = {"token": str(update.effective_chat.id), "platform": "telegram"}
-        await api_request("post", "/notifications/device", state, json_body=device_payload)
+        payment_id = int(arg.replace("payment_", ""))
+        resp = await api_request("get", f"/subscriptions/payments/{payment_id}", state)
+        return resp.get("status", "unknown")
     except Exception as exc:
-        # Log but don't fail the flow - notifications are optional
-        logger.warning("Notification registration failed: %s", exc)
-
-    return state
+        logger.warning("Payment deep link failed: %s", exc)
+        return None
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -344,26 +614,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state["input_mode"] = "chat"
     state["conversation_id"] = None
     state["attachments"] = []
-    await ensure_default_model(state)
     fire(state, "feature_opened", {"feature": "telegram_bot"})
 
-    # Handle deep links (e.g., /start payment_123)
-    if context.args:
-        arg = context.args[0]
-        if arg.startswith("payment_"):
-            try:
-                payment_id = int(arg.replace("payment_", ""))
-                resp = await api_request("get", f"/subscriptions/payments/{payment_id}", state)
-                status = resp.get("status", "unknown")
-                if status == "paid":
-                    await answer(update, "✅ To'lov muvaffaqiyatli amalga oshdi! Obunangiz faol.", markup=get_main_menu())
-                elif status in {"failed", "cancelled"}:
-                    await answer(update, "❌ To'lov amalga oshmadi yoki muddati tugadi. Qayta urinib ko'ring.", markup=get_main_menu())
-                else:
-                    await answer(update, f"⏳ To'lov holati: {status}", markup=get_main_menu())
-                return
-            except Exception as exc:
-                logger.warning("Payment deep link failed: %s", exc)
+    # Handle deep links (e.g., /start payment_123); the payment lookup runs
+    # alongside the model list fetch.
+    payment_arg = context.args[0] if context.args and context.args[0].startswith("payment_") else None
+    if payment_arg:
+        invalidate_user_cache(update.effective_user.id)
+    models, payment_status = await asyncio.gather(
+        load_models(state),
+        _payment_status(state, payment_arg) if payment_arg else _none(),
+    )
+    ensure_default_model(state, models)
+
+    if payment_status:
+        if payment_status == "paid":
+            await answer(update, "✅ To'lov muvaffaqiyatli amalga oshdi! Obunangiz faol.", markup=MAIN_MENU)
+        elif payment_status in {"failed", "cancelled"}:
+            await answer(update, "❌ To'lov amalga oshmadi yoki muddati tugadi. Qayta urinib ko'ring.", markup=MAIN_MENU)
+        else:
+            await answer(update, f"⏳ To'lov holati: {payment_status}", markup=MAIN_MENU)
+        return
 
     user = update.effective_user
 
@@ -375,7 +646,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "🚀 To'liq imkoniyatlar (taqdimot, fayl tahlili, ovozli suhbat) uchun "
         "<b>«Ilovani ochish»</b> tugmasini bosing."
     )
-    await answer(update, hello, markup=get_main_menu(), html_mode=True)
+    await answer(update, hello, markup=MAIN_MENU, html_mode=True)
 
 
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -407,17 +678,19 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # CRITICAL: Save the new tokens
         state["access_token"] = data["access_token"]
         state["refresh_token"] = data.get("refresh_token")
+        state["phone_verified"] = True
         
         # Register for notifications immediately
         try:
             device_payload = {"token": str(update.effective_chat.id), "platform": "telegram"}
             await api_request("post", "/notifications/device", state, json_body=device_payload)
+            state["device_registered"] = True
             success_text = "✅ Notifications enabled! You will now receive alerts here."
         except Exception as exc:
             logger.warning("Notification registration failed: %s", exc)
             success_text = "✅ Telefon raqamingiz tasdiqlandi!" # Fallback
 
-        await answer(update, success_text, markup=get_main_menu())
+        await answer(update, success_text, markup=MAIN_MENU)
         
     except Exception as exc:
         logger.exception("Phone update failed: %s", exc)
@@ -433,12 +706,16 @@ async def handle_new_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     state["conversation_id"] = None
     state["input_mode"] = "chat"
     state["attachments"] = []
-    await answer(update, "🆕 Yangi suhbat boshlandi. Savolingizni yozing yoki ovozli xabar yuboring.", markup=get_main_menu())
+    await answer(update, "🆕 Yangi suhbat boshlandi. Savolingizni yozing yoki ovozli xabar yuboring.", markup=MAIN_MENU)
 
 
 async def fetch_conversations(state: Dict[str, Any]) -> List[Dict[str, Any]]:
     try:
-        data = await api_request("get", "/conversations", state, params={"limit": 10})
+        # Only id/title/preview are rendered; backends that support field
+        # projection return just those, others ignore the parameter.
+        data = await api_request(
+            "get", "/conversations", state, params={"limit": 10, "fields": "id,title,preview"}
+        )
         return data if isinstance(data, list) else []
     except Exception as exc:
         logger.warning("Failed to load conversations: %s", exc)
@@ -449,7 +726,7 @@ async def choose_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
     state = await ensure_ready(update, context)
     conversations = await fetch_conversations(state)
     if not conversations:
-        await answer(update, "📭 Hali saqlangan suhbatlar yo'q.", markup=get_main_menu())
+        await answer(update, "📭 Hali saqlangan suhbatlar yo'q.", markup=MAIN_MENU)
         return
 
     rows = []
@@ -465,21 +742,57 @@ async def set_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE, c
     state = await ensure_ready(update, context)
     state["conversation_id"] = conv_id
     state["input_mode"] = "chat"
-    await answer(update, f"✅ Suhbat #{conv_id} tanlandi. Davom etishingiz mumkin.", markup=get_main_menu())
+    await answer(update, f"✅ Suhbat #{conv_id} tanlandi. Davom etishingiz mumkin.", markup=MAIN_MENU)
+
+
+_MODELS_CACHE: Optional[Tuple[float, List[Dict[str, Any]]]] = None
+# user_id -> path -> (fetched_at, response)
+_USER_CACHE: Dict[int, Dict[str, Tuple[float, Any]]] = {}
+
+
+async def cached_api_get(user_id: int, path: str, state: Dict[str, Any]) -> Any:
+    """GET `path` for this user, reusing a response younger than USER_CACHE_TTL."""
+    if USER_CACHE_TTL <= 0:
+        return await api_request("get", path, state)
+    entries = _USER_CACHE.get(user_id)
+    hit = entries.get(path) if entries else None
+    if hit and time.monotonic() - hit[0] < USER_CACHE_TTL:
+        return hit[1]
+    data = await api_request("get", path, state)
+    now = time.monotonic()
+    _USER_CACHE.setdefault(user_id, {})[path] = (now, data)
+    if len(_USER_CACHE) > 4096:
+        # Forget users whose entries have all expired.
+        expired = [
+            uid for uid, e in _USER_CACHE.items() if all(now - t >= USER_CACHE_TTL for t, _ in e.values())
+        ]
+        for uid in expired:
+            del _USER_CACHE[uid]
+    return data
+
+
+def invalidate_user_cache(user_id: int) -> None:
+    """Drop cached responses after the user changed their subscription or cards."""
+    _USER_CACHE.pop(user_id, None)
 
 
 async def load_models(state: Dict[str, Any]) -> List[Dict[str, Any]]:
+    global _MODELS_CACHE
+    if MODELS_CACHE_TTL > 0 and _MODELS_CACHE and time.monotonic() - _MODELS_CACHE[0] < MODELS_CACHE_TTL:
+        return _MODELS_CACHE[1]
     try:
         data = await api_request("get", "/chat/models", state)
-        return data if isinstance(data, list) else []
+        models = data if isinstance(data, list) else []
     except Exception as exc:
         logger.warning("Model list failed: %s", exc)
         return []
+    if MODELS_CACHE_TTL > 0 and models:
+        _MODELS_CACHE = (time.monotonic(), models)
+    return models
 
 
-async def ensure_default_model(state: Dict[str, Any]) -> None:
-    """Ensure the currently set model is allowed for this user."""
-    models = await load_models(state)
+def ensure_default_model(state: Dict[str, Any], models: List[Dict[str, Any]]) -> None:
+    """Ensure the currently set model is one of the already fetched `models`."""
     if not models:
         return
 
@@ -492,10 +805,10 @@ async def ensure_default_model(state: Dict[str, Any]) -> None:
 
 async def choose_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = await ensure_ready(update, context)
-    await ensure_default_model(state)
     models = await load_models(state)
+    ensure_default_model(state, models)
     if not models:
-        await answer(update, "⚠️ Model ro'yxatini olishda xatolik.", markup=get_main_menu())
+        await answer(update, "⚠️ Model ro'yxatini olishda xatolik.", markup=MAIN_MENU)
         return
 
     rows = []
@@ -514,13 +827,13 @@ async def choose_model(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def prompt_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = await ensure_ready(update, context)
     state["input_mode"] = "image"
-    await answer(update, "🖼️ Rasm tavsifini yuboring (masalan: 'Tog'dagi uy').", markup=get_main_menu())
+    await answer(update, "🖼️ Rasm tavsifini yuboring (masalan: 'Tog'dagi uy').", markup=MAIN_MENU)
 
 
 async def prompt_system_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = await ensure_ready(update, context)
     state["input_mode"] = "set_prompt"
-    await answer(update, "⚙️ Yangi tizim ko'rsatmasini (system prompt) yuboring.", markup=get_main_menu())
+    await answer(update, "⚙️ Yangi tizim ko'rsatmasini (system prompt) yuboring.", markup=MAIN_MENU)
 
 
 async def show_usage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -529,7 +842,7 @@ async def show_usage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         sub_usage = await api_request("get", "/subscriptions/usage", state)
     except Exception as exc:
         logger.exception("Usage fetch failed: %s", exc)
-        await answer(update, "⚠️ Statistika yuklashda xatolik.", markup=get_main_menu())
+        await answer(update, "⚠️ Statistika yuklashda xatolik.", markup=MAIN_MENU)
         return
 
     limits = sub_usage.get("limits", {})
@@ -544,7 +857,7 @@ async def show_usage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         f"🖼️ Rasmlar: {usage.get('images', 0)}/{limits.get('max_image_generations', 0)}\n"
         f"🎙️ Ovoz: {usage.get('voice_minutes', 0)}/{limits.get('max_voice_minutes', 0)} daqiqa\n"
     )
-    await answer(update, text, markup=get_main_menu(), html_mode=True)
+    await answer(update, text, markup=MAIN_MENU, html_mode=True)
 
 
 async def handle_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -616,17 +929,17 @@ async def initiate_payme_payment(update: Update, context: ContextTypes.DEFAULT_T
     state["input_mode"] = "chat"
     state["pending_plan_code"] = plan_code
     try:
-        resp = await api_request(
+        resp = await with_typing(update, api_request(
             "post", "/subscriptions/subscribe", state,
             json_body={"plan": plan_code, "provider": "payme", "platform": "telegram"},
-        )
+        ))
     except Exception as exc:
         logger.warning("Failed to create Payme checkout: %s", exc)
-        await answer(update, "⚠️ Payme havolasini yaratib bo'lmadi. Qayta urinib ko'ring.", markup=get_main_menu())
+        await answer(update, "⚠️ Payme havolasini yaratib bo'lmadi. Qayta urinib ko'ring.", markup=MAIN_MENU)
         return
     checkout_url = resp.get("checkout_url")
     if not checkout_url:
-        await answer(update, "⚠️ Payme havolasi topilmadi. Qayta urinib ko'ring.", markup=get_main_menu())
+        await answer(update, "⚠️ Payme havolasi topilmadi. Qayta urinib ko'ring.", markup=MAIN_MENU)
         return
     rows = [
         [InlineKeyboardButton("🟢 Payme orqali to'lash", url=checkout_url)],
@@ -648,20 +961,20 @@ async def initiate_one_time_payment(update: Update, context: ContextTypes.DEFAUL
     state["input_mode"] = "chat"
     state["pending_plan_code"] = plan_code
     try:
-        resp = await api_request(
+        resp = await with_typing(update, api_request(
             "post",
             "/subscriptions/subscribe",
             state,
             json_body={"plan": plan_code, "provider": "click", "platform": "telegram"},
-        )
+        ))
     except Exception as exc:
         logger.warning("Failed to create Click checkout: %s", exc)
-        await answer(update, "⚠️ To'lov havolasini yaratib bo'lmadi. Qayta urinib ko'ring.", markup=get_main_menu())
+        await answer(update, "⚠️ To'lov havolasini yaratib bo'lmadi. Qayta urinib ko'ring.", markup=MAIN_MENU)
         return
 
     checkout_url = resp.get("checkout_url")
     if not checkout_url:
-        await answer(update, "⚠️ Click havolasi topilmadi. Qayta urinib ko'ring.", markup=get_main_menu())
+        await answer(update, "⚠️ Click havolasi topilmadi. Qayta urinib ko'ring.", markup=MAIN_MENU)
         return
 
     rows = [
@@ -728,16 +1041,17 @@ async def handle_card_expiry(update: Update, context: ContextTypes.DEFAULT_TYPE,
     card_number = state.get("pending_card_number")
     if not card_number:
         state["input_mode"] = "chat"
-        await answer(update, "⚠️ Karta raqami topilmadi. Qaytadan boshlang.", markup=get_main_menu())
+        await answer(update, "⚠️ Karta raqami topilmadi. Qaytadan boshlang.", markup=MAIN_MENU)
         return
 
-    status_msg = await update.message.reply_text("⏳ Karta tekshirilmoqda...")
-
+    status_msg = None
     try:
-        resp = await api_request(
+        task = asyncio.create_task(with_typing(update, api_request(
             "post", "/cards/tokenize/request", state,
             json_body={"card_number": card_number, "expire_date": digits},
-        )
+        )))
+        status_msg = await deferred_status(update, task, "⏳ Karta tekshirilmoqda...")
+        resp = await task
         request_id = resp.get("request_id")
         phone_hint = resp.get("phone_hint", "")
 
@@ -746,11 +1060,7 @@ async def handle_card_expiry(update: Update, context: ContextTypes.DEFAULT_TYPE,
         state["input_mode"] = "sms_code"
 
         hint_text = f" ({phone_hint})" if phone_hint else ""
-        await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=status_msg.message_id,
-            text=f"📱 SMS kod yuborildi{hint_text}.\n\nKodni kiriting:",
-        )
+        await finish_status(update, context, status_msg, f"📱 SMS kod yuborildi{hint_text}.\n\nKodni kiriting:")
     except Exception as exc:
         logger.exception("Tokenize request failed: %s", exc)
         error_detail = _extract_api_error(exc)
@@ -760,10 +1070,11 @@ async def handle_card_expiry(update: Update, context: ContextTypes.DEFAULT_TYPE,
             [InlineKeyboardButton("❌ Bekor qilish", callback_data="cancel_payment")],
         ]
         state["input_mode"] = "chat"
-        await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=status_msg.message_id,
-            text=f"⚠️ Xatolik: {html.escape(error_detail)}\n\nBoshqa karta bilan urinib ko'ring yoki bekor qiling.",
+        await finish_status(
+            update,
+            context,
+            status_msg,
+            f"⚠️ Xatolik: {html.escape(error_detail)}\n\nBoshqa karta bilan urinib ko'ring yoki bekor qiling.",
             parse_mode=ParseMode.HTML,
             reply_markup=InlineKeyboardMarkup(rows),
         )
@@ -783,26 +1094,29 @@ async def handle_sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE, te
 
     if not request_id or not plan_code:
         state["input_mode"] = "chat"
-        await answer(update, "⚠️ Sessiya tugadi. Qaytadan boshlang.", markup=get_main_menu())
+        await answer(update, "⚠️ Sessiya tugadi. Qaytadan boshlang.", markup=MAIN_MENU)
         return
 
-    status_msg = await update.message.reply_text("⏳ Tasdiqlanmoqda va to'lov amalga oshirilmoqda...")
-
+    status_msg = None
     try:
-        resp = await api_request(
+        task = asyncio.create_task(with_typing(update, api_request(
             "post", "/cards/tokenize/verify", state,
             json_body={"request_id": request_id, "sms_code": int(code), "plan_code": plan_code},
-        )
+        )))
+        status_msg = await deferred_status(update, task, "⏳ Tasdiqlanmoqda va to'lov amalga oshirilmoqda...")
+        resp = await task
+        invalidate_user_cache(update.effective_user.id)
 
         if resp.get("success"):
             sub_info = resp.get("subscription", {})
             plan_name = sub_info.get("plan", plan_code)
             expires = sub_info.get("expires_at", "")
 
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=status_msg.message_id,
-                text=(
+            await finish_status(
+                update,
+                context,
+                status_msg,
+                (
                     f"✅ <b>Obuna muvaffaqiyatli faollashtirildi!</b>\n\n"
                     f"📋 Reja: <b>{html.escape(plan_name)}</b>\n"
                     f"📅 Amal qilish: {html.escape(expires[:10] if expires else 'N/A')}\n"
@@ -812,11 +1126,7 @@ async def handle_sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE, te
                 parse_mode=ParseMode.HTML,
             )
         else:
-            await context.bot.edit_message_text(
-                chat_id=update.effective_chat.id,
-                message_id=status_msg.message_id,
-                text="⚠️ Tasdiqlash amalga oshmadi. Qayta urinib ko'ring.",
-            )
+            await finish_status(update, context, status_msg, "⚠️ Tasdiqlash amalga oshmadi. Qayta urinib ko'ring.")
     except Exception as exc:
         logger.exception("SMS verify failed: %s", exc)
         error_detail = _extract_api_error(exc)
@@ -826,10 +1136,11 @@ async def handle_sms_code(update: Update, context: ContextTypes.DEFAULT_TYPE, te
             [InlineKeyboardButton("💳 Kartani o'zgartirish", callback_data="retry_card")],
             [InlineKeyboardButton("❌ Bekor qilish", callback_data="cancel_payment")],
         ]
-        await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=status_msg.message_id,
-            text=f"⚠️ Xatolik: {html.escape(error_detail)}\n\nQuyidagi amallardan birini tanlang:",
+        await finish_status(
+            update,
+            context,
+            status_msg,
+            f"⚠️ Xatolik: {html.escape(error_detail)}\n\nQuyidagi amallardan birini tanlang:",
             parse_mode=ParseMode.HTML,
             reply_markup=InlineKeyboardMarkup(rows),
         )
@@ -848,10 +1159,10 @@ async def show_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Show current subscription status with management options."""
     state = await ensure_ready(update, context)
     try:
-        current = await api_request("get", "/subscriptions/current", state)
+        current = await cached_api_get(update.effective_user.id, "/subscriptions/current", state)
     except Exception as exc:
         logger.warning("Failed to fetch subscription: %s", exc)
-        await answer(update, "⚠️ Obuna ma'lumotlarini yuklashda xatolik.", markup=get_main_menu())
+        await answer(update, "⚠️ Obuna ma'lumotlarini yuklashda xatolik.", markup=MAIN_MENU)
         return
 
     if not current.get("active"):
@@ -889,14 +1200,14 @@ async def show_saved_cards(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     """Show user's saved cards with delete option."""
     state = await ensure_ready(update, context)
     try:
-        cards = await api_request("get", "/cards", state)
+        cards = await cached_api_get(update.effective_user.id, "/cards", state)
     except Exception as exc:
         logger.warning("Failed to fetch cards: %s", exc)
         await answer(update, "⚠️ Kartalarni yuklashda xatolik.")
         return
 
     if not cards:
-        await answer(update, "Saqlangan kartalar yo'q.", markup=get_main_menu())
+        await answer(update, "Saqlangan kartalar yo'q.", markup=MAIN_MENU)
         return
 
     text = "<b>💳 Saqlangan kartalar</b>\n\n"
@@ -914,14 +1225,14 @@ async def show_saved_cards(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def prompt_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = await ensure_ready(update, context)
     state["input_mode"] = "feedback"
-    await answer(update, "📩 Fikr va takliflaringizni yozib qoldiring.", markup=get_main_menu())
+    await answer(update, "📩 Fikr va takliflaringizni yozib qoldiring.", markup=MAIN_MENU)
 
 
 async def submit_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str) -> None:
     state = await ensure_ready(update, context)
     try:
         await api_request("post", "/feedback", state, json_body={"content": text, "platform": "telegram"})
-        await answer(update, "✅ Fikr-mulohazangiz qabul qilindi. Rahmat!", markup=get_main_menu())
+        await answer(update, "✅ Fikr-mulohazangiz qabul qilindi. Rahmat!", markup=MAIN_MENU)
     except Exception as exc:
         logger.exception("Feedback submission failed: %s", exc)
         await answer(update, "⚠️ Xatolik yuz berdi.")
@@ -932,31 +1243,11 @@ async def submit_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE, te
 # --- Message processing ---------------------------------------------------- #
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = update.message.text
-    
+
     # Handle Menu Commands
-    if text == BTN_NEW_CHAT:
-        await handle_new_chat(update, context)
-        return
-    elif text == BTN_HISTORY:
-        await choose_conversation(update, context)
-        return
-    elif text == BTN_IMAGE:
-        await prompt_image(update, context)
-        return
-    elif text == BTN_MODEL:
-        await choose_model(update, context)
-        return
-    elif text == BTN_SETTINGS:
-        await prompt_system_prompt(update, context)
-        return
-    elif text == BTN_SUBSCRIBE:
-        await handle_subscribe(update, context)
-        return
-    elif text == BTN_FEEDBACK:
-        await prompt_feedback(update, context)
-        return
-    elif text == BTN_HELP:
-        await start(update, context)
+    button_handler = _BUTTON_HANDLERS.get(text)
+    if button_handler:
+        await button_handler(update, context)
         return
 
     # Handle Normal Input
@@ -967,22 +1258,68 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             return
         raise e
 
-    mode = state.get("input_mode", "chat")
-    
-    if mode == "image":
-        await generate_image(update, context, text)
-    elif mode == "set_prompt":
-        await update_system_prompt(update, context, text)
-    elif mode == "feedback":
-        await submit_feedback(update, context, text)
-    elif mode == "card_number":
-        await handle_card_number(update, context, text)
-    elif mode == "card_expiry":
-        await handle_card_expiry(update, context, text)
-    elif mode == "sms_code":
-        await handle_sms_code(update, context, text)
+    mode_handler = _MODE_HANDLERS.get(state.get("input_mode", "chat"), handle_chat)
+    await mode_handler(update, context, text)
+
+
+# Streaming edit cadence. Telegram allows roughly one edit per second per
+# chat, so short replies refresh quickest and long replies edit less often.
+DEFAULT_STREAMING_EDIT_INTERVAL = 0.8
+DEFAULT_STREAMING_BUFFER_THRESHOLD = 24
+# Server-sent events framing of /chat/stream.
+_SSE_DATA = "data: "
+_SSE_DATA_LEN = len(_SSE_DATA)
+_SSE_SKIP = frozenset({"", " ", "[DONE]"})
+# LLM replies can stream for a while, but a dead backend should fail fast.
+STREAM_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+# SSE payloads the reader may run ahead of the consumer before it waits.
+_SSE_QUEUE_SIZE = 128
+
+
+async def _read_sse_data(response: httpx.Response, lines: "asyncio.Queue[Any]") -> None:
+    """Feed the payload of each "data: " line into `lines`, then None.
+
+    A read error is queued in place of the None so the consumer raises it.
+    """
+    try:
+        async for line in response.aiter_lines():
+            # aiter_lines() already drops the line terminator and orjson
+            # ignores surrounding whitespace, so no strip().
+            if line[:_SSE_DATA_LEN] == _SSE_DATA:
+                await lines.put(line[_SSE_DATA_LEN:])
+    except Exception as exc:
+        await lines.put(exc)
+        return
+    await lines.put(None)
+
+
+def _should_flush(buffer_len: int, elapsed: float, total_len: int, backoff: float = 1.0) -> bool:
+    """Decide whether the buffered text is worth an interim edit.
+
+    `interval` is the minimum gap between edits. Once it has passed, a full
+    buffer flushes right away and a smaller one waits up to twice as long.
+    Thresholds grow with the reply length; `backoff` stretches them after
+    Telegram answered with RetryAfter.
+    """
+    if total_len <= 320:
+        interval, threshold = DEFAULT_STREAMING_EDIT_INTERVAL, DEFAULT_STREAMING_BUFFER_THRESHOLD
+    elif total_len <= 1024:
+        interval, threshold = 1.0, 32
     else:
-        await handle_chat(update, context, text)
+        interval, threshold = 1.5, 40
+    interval *= backoff
+    return elapsed >= interval and (buffer_len >= threshold * backoff or elapsed >= 2 * interval)
+
+
+@dataclass(slots=True)
+class StreamResult:
+    """Outcome of one /chat/stream attempt."""
+
+    reply: str = ""
+    conversation_id: Optional[int] = None
+    status: str = "ok"  # "ok", "auth" (401, refresh and retry) or "error"
+    error: str = ""
+    limit_exceeded: bool = False
 
 
 async def stream_chat_response(
@@ -991,56 +1328,72 @@ async def stream_chat_response(
     message_id: int,
     payload: Dict[str, Any],
     state: Dict[str, Any],
-) -> Dict[str, Any]:
-    """Stream chat response to Telegram with throttling and auto-refresh on 401."""
-    url = build_url("/chat/stream")
-    
-    async def _stream(token: str) -> Optional[Dict[str, Any]]:
+    on_done: Optional[Callable[[str], Awaitable[None]]] = None,
+) -> StreamResult:
+    """Stream chat response to Telegram with throttling and auto-refresh on 401.
+
+    `on_done` is awaited with the full reply as soon as the backend sends its
+    "done" event, before the final Markdown edit.
+    """
+
+    async def _stream(token: str) -> StreamResult:
         headers = {"Authorization": f"Bearer {token}"}
         full_text = ""
         buffer = ""
-        last_update_time = time.time()
-        result = {"conversation_id": None, "reply": ""}
+        loop = asyncio.get_running_loop()
+        last_update_time = loop.time()
+        last_edited_text = ""
+        stream_done = False
+        backoff = 1.0
+        edits_paused_until = 0.0
+        result = StreamResult()
         
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                async with client.stream("POST", url, json=payload, headers=headers) as response:
+            async with HTTP.stream(
+                "POST", "/chat/stream", json=payload, headers=headers, timeout=STREAM_TIMEOUT
+            ) as response:
                     
-                    # Check for 401 immediately
-                    if response.status_code == 401:
-                        return None # Signal need to refresh
-
-                    if response.status_code != 200:
-                        # MUST use aread() on an async streaming response — read()
-                        # raises "Attempted to call a sync iterator on an async
-                        # stream", which previously crashed the limit (403) path.
-                        error_body = await response.aread()
-                        error_text = error_body.decode('utf-8')
-                        # Try to parse structured error
-                        try:
-                            err_data = json.loads(error_text)
-                            detail = err_data.get("detail")
-                            if isinstance(detail, dict) and detail.get("code") in ("LIMIT_EXCEEDED", "FREE_DAILY_REACHED"):
-                                result["error"] = detail.get("message", error_text)
-                                result["limit_exceeded"] = True
-                                return result
-                            elif isinstance(detail, str):
-                                error_text = detail
-                        except (json.JSONDecodeError, ValueError):
-                            pass
-                        result["error"] = f"HTTP {response.status_code}: {error_text}"
-                        return result
-
-                    async for line in response.aiter_lines():
-                        if not line.startswith("data: "):
-                            continue
-                        
+                # Check for 401 immediately
+                if response.status_code == 401:
+                    return StreamResult(status="auth")
+
+                if response.status_code != 200:
+                    # MUST use aread() on an async streaming response — read()
+                    # raises "Attempted to call a sync iterator on an async
+                    # stream", which previously crashed the limit (403) path.
+                    error_body = await response.aread()
+                    error_text = error_body.decode('utf-8')
+                    # Try to parse structured error
+                    try:
+                        err_data = orjson.loads(error_body)
+                        detail = err_data.get("detail")
+                        if isinstance(detail, dict) and detail.get("code") in ("LIMIT_EXCEEDED", "FREE_DAILY_REACHED"):
+                            result.status = "error"
+                            result.error = detail.get("message", error_text)
+                            result.limit_exceeded = True
+                            return result
+                        elif isinstance(detail, str):
+                            error_text = detail
+                    except (orjson.JSONDecodeError, AttributeError):
+                        pass
+                    result.status = "error"
+                    result.error = f"HTTP {response.status_code}: {error_text}"
+                    return result
+
+                # A reader task keeps draining the response while this loop
+                # decodes events and waits on Telegram edits.
+                lines: asyncio.Queue = asyncio.Queue(maxsize=_SSE_QUEUE_SIZE)
+                reader = asyncio.create_task(_read_sse_data(response, lines))
+                try:
+                    while (line_content := await lines.get()) is not None:
+                        if isinstance(line_content, Exception):
+                            raise line_content
+
                         try:
-                            line_content = line[6:].strip()
-                            if not line_content or line_content == "[DONE]":
+                            if line_content in _SSE_SKIP:
                                 continue
                                 
-                            data = json.loads(line_content)
+                            data = orjson.loads(line_content)
                             event_type = data.get("type")
                             
                             if event_type == "chunk":
@@ -1050,74 +1403,94 @@ async def stream_chat_response(
                                     buffer += content
                                     
                                     # Throttling
-                                    current_time = time.time()
-                                    if len(buffer) > 20 or (current_time - last_update_time) > 1.5:
+                                    current_time = loop.time()
+                                    total_len = len(full_text)
+                                    # Telegram trims trailing whitespace, so whitespace-only
+                                    # tokens would re-send the same visible text. After
+                                    # "done" the final Markdown edit replaces the cursor.
+                                    rendered = full_text.rstrip() + " ▌"
+                                    # Interim edits never wait for a limiter token: when
+                                    # the chat's bucket is empty the edit is skipped and
+                                    # the text goes out with a later one.
+                                    if (
+                                        not stream_done
+                                        and rendered != last_edited_text
+                                        and current_time >= edits_paused_until
+                                        and _should_flush(len(buffer), current_time - last_update_time, total_len, backoff)
+                                        and TELEGRAM_LIMITER.try_take(chat_id)
+                                    ):
                                         try:
-                                            await bot.edit_message_text(
-                                                chat_id=chat_id,
-                                                message_id=message_id,
-                                                text=full_text + " ▌",
-                                                parse_mode=None
+                                            await telegram_call(
+                                                lambda: bot.edit_message_text(
+                                                    rendered, chat_id=chat_id, message_id=message_id, parse_mode=None
+                                                ),
+                                                max_retries=0,
                                             )
                                             buffer = ""
                                             last_update_time = current_time
+                                            last_edited_text = rendered
                                         except RetryAfter as e:
-                                            await asyncio.sleep(e.retry_after)
+                                            # Flood control hit: keep reading but hold interim edits
+                                            # for the requested pause, then edit less often. Sleeping
+                                            # here would stall every other update.
+                                            backoff *= 1.5
+                                            edits_paused_until = loop.time() + e.retry_after
                                         except Exception:
                                             pass
                                             
                             elif event_type == "done":
-                                result["conversation_id"] = data.get("conversation_id")
+                                stream_done = True
+                                result.conversation_id = data.get("conversation_id")
+                                if on_done and full_text:
+                                    await on_done(full_text)
                                 
                             elif event_type == "error":
-                                result["error"] = data.get("message")
+                                result.error = data.get("message") or ""
+                                if result.error:
+                                    result.status = "error"
                                 
-                        except json.JSONDecodeError:
+                        except orjson.JSONDecodeError:
                             continue
+                finally:
+                    # Still inside `async with`, so the reader is gone before
+                    # the response is closed.
+                    reader.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await reader
         except Exception as e:
             logger.error(f"Stream error: {e}")
             full_text += f"\n\n[Xatolik: {str(e)}]"
-            result["error"] = str(e) # Capture error
+            result.status = "error"
+            result.error = str(e) # Capture error
 
-        result["reply"] = full_text
+        result.reply = full_text
         return result
 
     # First attempt
-    current_token = state.get("access_token")
-    data = await _stream(current_token)
+    data = await _stream(state["access_token"])
     
-    # Handle refresh if needed (returns None on 401)
-    if data is None:
+    # Handle refresh if needed
+    if data.status == "auth":
         logger.info("Got 401 in stream, refreshing token...")
         if await refresh_tokens(state):
-            current_token = state.get("access_token")
-            data = await _stream(current_token)
-            if data is None: # Still 401
-                data = {"reply": "", "error": "Autentifikatsiya eskirgan. Iltimos qayta kiring."}
+            data = await _stream(state["access_token"])
+            if data.status == "auth": # Still 401
+                data = StreamResult(status="error", error="Autentifikatsiya eskirgan. Iltimos qayta kiring.")
         else:
-             data = {"reply": "", "error": "Token yangilanmadi. Iltimos qayta kiring."}
+             data = StreamResult(status="error", error="Token yangilanmadi. Iltimos qayta kiring.")
 
     # Final UI update logic (unchanged)
-    full_text = data.get("reply", "")
+    full_text = data.reply
     try:
         final_text = full_text if full_text else "Javob olinmadi."
-        if data.get("error") and not full_text:
-             final_text = f"⚠️ {data['error']}"
+        if data.error and not full_text:
+             final_text = f"⚠️ {data.error}"
 
-        await bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=final_text,
-            parse_mode=ParseMode.MARKDOWN
-        )
+        await limited_edit_message_text(bot, chat_id, message_id, final_text, parse_mode=ParseMode.MARKDOWN)
     except Exception:
         with contextlib.suppress(Exception):
-            await bot.edit_message_text(
-                chat_id=chat_id, 
-                message_id=message_id, 
-                text=final_text, # Use the computed final text
-                parse_mode=None
-            )
+            # Use the computed final text
+            await limited_edit_message_text(bot, chat_id, message_id, final_text, parse_mode=None)
             
     return data
 
@@ -1128,13 +1501,15 @@ async def handle_chat(
     user_text: str,
     *,
     return_reply: bool = False,
+    on_done: Optional[Callable[[str], Awaitable[None]]] = None,
 ) -> Optional[str]:
     state = await ensure_ready(update, context)
     chat_id = update.effective_chat.id
     
-    # Send initial status
-    await context.bot.send_chat_action(chat_id, ChatAction.TYPING)
-    status_msg = await update.message.reply_text("⏳ Salom AI o'ylayapti...")
+    # The placeholder is the progress indicator, so no separate "typing" action.
+    status_msg = await telegram_call(
+        lambda: update.message.reply_text("⏳ Salom AI o'ylayapti..."), chat_id=chat_id
+    )
 
     payload = {
         "text": user_text,
@@ -1145,32 +1520,29 @@ async def handle_chat(
         payload["attachments"] = state["attachments"]
 
     try:
-        # Check authentication token validity first
-        if not state.get("access_token"):
-             await authenticate_user(update.effective_user.id, update.effective_user.first_name, update.effective_user.username, state)
-
+        # ensure_ready above has already authenticated; a stale token is
+        # refreshed inside stream_chat_response.
         # Start streaming
         data = await stream_chat_response(
             context.bot, 
             chat_id, 
             status_msg.message_id, 
             payload, 
-            state
+            state,
+            on_done=on_done,
         )
         
-        # If we got a 401 during stream (which is hard to catch mid-stream with httpx), 
-        # normally we'd need to retry. For simplicity, we assume auth is valid or handled.
-        # Ideally, stream_chat_response could return a specific error code.
-        
-        if data.get("error"):
-            error_text = data['error']
+        # A 401 has already been refreshed and retried inside stream_chat_response.
+        if data.status == "error":
+            error_text = data.error
             # Check if the error contains LIMIT_EXCEEDED indicators
-            if data.get("limit_exceeded") or "LIMIT_EXCEEDED" in error_text or "limitga yetdingiz" in error_text:
+            if data.limit_exceeded or "LIMIT_EXCEEDED" in error_text or "limitga yetdingiz" in error_text:
                 rows = [[InlineKeyboardButton("💎 Obunani yangilash", callback_data="goto_subscribe")]]
-                await context.bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=status_msg.message_id,
-                    text=f"⚠️ {error_text}\n\nObunangizni yangilang:",
+                await limited_edit_message_text(
+                    context.bot,
+                    chat_id,
+                    status_msg.message_id,
+                    f"⚠️ {error_text}\n\nObunangizni yangilang:",
                     reply_markup=InlineKeyboardMarkup(rows),
                 )
                 return None
@@ -1182,21 +1554,23 @@ async def handle_chat(
         if _is_limit_exceeded(exc):
             error_detail = _extract_api_error(exc)
             rows = [[InlineKeyboardButton("💎 Obunani yangilash", callback_data="goto_subscribe")]]
-            await context.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=status_msg.message_id,
-                text=f"⚠️ {error_detail}\n\nObunangizni yangilang:",
+            await limited_edit_message_text(
+                context.bot,
+                chat_id,
+                status_msg.message_id,
+                f"⚠️ {error_detail}\n\nObunangizni yangilang:",
                 reply_markup=InlineKeyboardMarkup(rows),
             )
             return None
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=status_msg.message_id,
-            text="⚠️ Kechirasiz, xatolik yuz berdi. Qayta urinib ko'ring."
+        await limited_edit_message_text(
+            context.bot,
+            chat_id,
+            status_msg.message_id,
+            "⚠️ Kechirasiz, xatolik yuz berdi. Qayta urinib ko'ring.",
         )
         return None
 
-    state["conversation_id"] = data.get("conversation_id")
+    state["conversation_id"] = data.conversation_id
     state["input_mode"] = "chat"
     state["attachments"] = []
     fire(state, "chat_message", {"model": state.get("model")})
@@ -1206,30 +1580,35 @@ async def handle_chat(
         n = int(state.get("msgs_since_nudge", 0)) + 1
         if n >= 4:
             state["msgs_since_nudge"] = 0
-            await context.bot.send_message(
-                chat_id,
-                "✨ <b>Salom AI ilovasi</b>da ko‘proq imkoniyat bor: taqdimot, referat, "
-                "fayl tahlili, ovozli suhbat va DTM mashqlari — qulayroq va tezkor.",
-                parse_mode=ParseMode.HTML,
-                reply_markup=webapp_inline_kb("🚀 Ilovada ochish"),
+            await telegram_call(
+                lambda: context.bot.send_message(
+                    chat_id,
+                    "✨ <b>Salom AI ilovasi</b>da ko‘proq imkoniyat bor: taqdimot, referat, "
+                    "fayl tahlili, ovozli suhbat va DTM mashqlari — qulayroq va tezkor.",
+                    parse_mode=ParseMode.HTML,
+                    reply_markup=webapp_inline_kb("🚀 Ilovada ochish"),
+                ),
+                chat_id=chat_id,
             )
         else:
             state["msgs_since_nudge"] = n
     except Exception:
         pass
 
-    reply_text = data.get("reply", "")
-    return reply_text if return_reply else None
+    return data.reply if return_reply else None
 
 
 async def open_app(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """/app — quick entry to the full Salom AI Mini App."""
-    await update.message.reply_text(
-        "🚀 <b>Salom AI ilovasi</b> — barcha imkoniyatlar bir joyda:\n"
-        "• AI taqdimot va referat\n• Fayl va rasm tahlili\n• Ovozli suhbat\n• DTM mashqlari\n\n"
-        "Pastdagi tugmani bosing 👇",
-        parse_mode=ParseMode.HTML,
-        reply_markup=webapp_inline_kb("🚀 Ilovani ochish"),
+    await telegram_call(
+        lambda: update.message.reply_text(
+            "🚀 <b>Salom AI ilovasi</b> — barcha imkoniyatlar bir joyda:\n"
+            "• AI taqdimot va referat\n• Fayl va rasm tahlili\n• Ovozli suhbat\n• DTM mashqlari\n\n"
+            "Pastdagi tugmani bosing 👇",
+            parse_mode=ParseMode.HTML,
+            reply_markup=webapp_inline_kb("🚀 Ilovani ochish"),
+        ),
+        chat_id=update.effective_chat.id,
     )
 
 
@@ -1241,7 +1620,10 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE, pro
         data = await api_request("post", "/images/generate", state, json_body={"prompt": prompt})
         image_url = data.get("url")
         if image_url:
-            await update.message.reply_photo(image_url, caption=f"🖼️ {prompt}")
+            await telegram_call(
+                lambda: update.message.reply_photo(image_url, caption=f"🖼️ {prompt}"),
+                chat_id=update.effective_chat.id,
+            )
         else:
             await answer(update, "⚠️ Rasm URL olinmadi.")
     except Exception as exc:
@@ -1261,7 +1643,7 @@ async def update_system_prompt(update: Update, context: ContextTypes.DEFAULT_TYP
     state = await ensure_ready(update, context)
     try:
         await api_request("put", "/settings", state, json_body={"system_prompt": prompt})
-        await answer(update, "✅ Tizim ko'rsatmasi yangilandi.", markup=get_main_menu())
+        await answer(update, "✅ Tizim ko'rsatmasi yangilandi.", markup=MAIN_MENU)
     except Exception as exc:
         logger.exception("Settings update failed: %s", exc)
         await answer(update, "⚠️ Sozlamani saqlashda xatolik.")
@@ -1269,53 +1651,76 @@ async def update_system_prompt(update: Update, context: ContextTypes.DEFAULT_TYP
         state["input_mode"] = "chat"
 
 
+# Routing tables for handle_text: reply-keyboard buttons, then input modes.
+_BUTTON_HANDLERS: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]] = {
+    BTN_NEW_CHAT: handle_new_chat,
+    BTN_HISTORY: choose_conversation,
+    BTN_IMAGE: prompt_image,
+    BTN_MODEL: choose_model,
+    BTN_SETTINGS: prompt_system_prompt,
+    BTN_SUBSCRIBE: handle_subscribe,
+    BTN_FEEDBACK: prompt_feedback,
+    BTN_HELP: start,
+}
+
+# Anything not listed (including "chat") goes to handle_chat.
+_MODE_HANDLERS: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE, str], Awaitable[Any]]] = {
+    "image": generate_image,
+    "set_prompt": update_system_prompt,
+    "feedback": submit_feedback,
+    "card_number": handle_card_number,
+    "card_expiry": handle_card_expiry,
+    "sms_code": handle_sms_code,
+}
+
+
 # --- Attachments ----------------------------------------------------------- #
-async def upload_file_to_backend(state: Dict[str, Any], file_path: str, file_name: str, mime: str) -> Dict[str, Any]:
-    """Upload a file. Returns {"url": ...} on success, {"limit": True, "message": ...}
-    when the plan limit is hit (so callers can prompt an upgrade), or {"error": ...}."""
-    def _request(token: str):
-        headers = {"Authorization": f"Bearer {token}"} if token else {}
-        with open(file_path, "rb") as f:
-            files = {"file": (file_name, f, mime)}
-            resp = requests.post(
-                build_url("/files/upload"),
-                files=files,
-                headers=headers,
-                timeout=REQUEST_TIMEOUT,
-            )
-            return resp
+# Documents up to this size are downloaded into memory; bigger ones (only
+# possible with a local Bot API server) are spooled through a temp file.
+IN_MEMORY_UPLOAD_LIMIT = 20 * 1024 * 1024
 
-    resp = await asyncio.to_thread(_request, state.get("access_token"))
-    if resp.status_code == 401 and await refresh_tokens(state):
-        resp = await asyncio.to_thread(_request, state.get("access_token"))
 
-    if resp.ok:
-        try:
-            url = resp.json().get("url")
-            return {"url": url} if url else {"error": "no_url"}
-        except Exception:
-            return {"error": "bad_response"}
+async def _upload_to_backend(state: Dict[str, Any], upload: Tuple[str, Any, str]) -> Dict[str, Any]:
+    try:
+        data = await api_request("post", "/files/upload", state, files={"file": upload})
+    except ApiError as exc:
+        # Limit hit → let the caller convert (upgrade prompt) instead of a dead error.
+        if exc.status == 403 and exc.code in ("LIMIT_EXCEEDED", "FREE_DAILY_REACHED"):
+            return {"limit": True, "message": exc.detail.get("message")}
+        logger.warning("File upload failed: HTTP %s — %s", exc.status, exc.text[:300])
+        return {"error": f"HTTP {exc.status}"}
+    except ValueError:
+        return {"error": "bad_response"}
+
+    url = data.get("url") if isinstance(data, dict) else None
+    return {"url": url} if url else {"error": "no_url"}
+
+
+async def upload_bytes_to_backend(state: Dict[str, Any], data: bytes, file_name: str, mime: str) -> Dict[str, Any]:
+    """Upload an in-memory file. Returns {"url": ...} on success, {"limit": True, "message": ...}
+    when the plan limit is hit (so callers can prompt an upgrade), or {"error": ...}."""
+    return await _upload_to_backend(state, (file_name, data, mime))
 
-    # Limit hit → let the caller convert (upgrade prompt) instead of a dead error.
-    if resp.status_code == 403:
-        try:
-            detail = resp.json().get("detail")
-            if isinstance(detail, dict) and detail.get("code") in ("LIMIT_EXCEEDED", "FREE_DAILY_REACHED"):
-                return {"limit": True, "message": detail.get("message")}
-        except Exception:
-            pass
 
-    logger.warning("File upload failed: HTTP %s — %s", resp.status_code, (resp.text or "")[:300])
-    return {"error": f"HTTP {resp.status_code}"}
+async def upload_file_to_backend(state: Dict[str, Any], file_path: str, file_name: str, mime: str) -> Dict[str, Any]:
+    """Same as upload_bytes_to_backend, but streams the body from a file on disk."""
+    # httpx streams the multipart body from the open handle and rewinds it
+    # for the 401 retry inside api_request.
+    with open(file_path, "rb") as f:
+        return await _upload_to_backend(state, (file_name, f, mime))
 
 
 async def _send_upgrade_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, message: Optional[str]) -> None:
     """Show a clean upgrade CTA when a file/limit is hit — convert, don't dead-end."""
     rows = [[InlineKeyboardButton("💎 Obunani yangilash", callback_data="goto_subscribe")]]
-    await context.bot.send_message(
-        update.effective_chat.id,
-        f"📎 {message or 'Fayl tahlili limiti tugadi.'}\n\nFayllarni cheksiz tahlil qilish uchun Pro tarifiga o'ting:",
-        reply_markup=InlineKeyboardMarkup(rows),
+    chat_id = update.effective_chat.id
+    await telegram_call(
+        lambda: context.bot.send_message(
+            chat_id,
+            f"📎 {message or 'Fayl tahlili limiti tugadi.'}\n\nFayllarni cheksiz tahlil qilish uchun Pro tarifiga o'ting:",
+            reply_markup=InlineKeyboardMarkup(rows),
+        ),
+        chat_id=chat_id,
     )
 
 
@@ -1323,12 +1728,11 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     state = await ensure_ready(update, context)
     photo = update.message.photo[-1]
     file = await context.bot.get_file(photo.file_id)
-    with tempfile.NamedTemporaryFile(delete=True, suffix=".jpg") as tmp:
-        await file.download_to_drive(tmp.name)
-        res = await upload_file_to_backend(state, tmp.name, os.path.basename(tmp.name), "image/jpeg")
+    buf = await file.download_as_bytearray()
+    res = await upload_bytes_to_backend(state, bytes(buf), f"{photo.file_unique_id}.jpg", "image/jpeg")
     if res.get("url"):
         state.setdefault("attachments", []).append(res["url"])
-        await answer(update, "📎 Rasm biriktirildi. Matn yuboring.", markup=get_main_menu())
+        await answer(update, "📎 Rasm biriktirildi. Matn yuboring.", markup=MAIN_MENU)
     elif res.get("limit"):
         await _send_upgrade_prompt(update, context, res.get("message"))
     else:
@@ -1340,17 +1744,18 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     doc = update.message.document
     file = await context.bot.get_file(doc.file_id)
     suffix = os.path.splitext(doc.file_name or "file")[1] or ".dat"
-    with tempfile.NamedTemporaryFile(delete=True, suffix=suffix) as tmp:
-        await file.download_to_drive(tmp.name)
-        res = await upload_file_to_backend(
-            state,
-            tmp.name,
-            doc.file_name or os.path.basename(tmp.name),
-            doc.mime_type or "application/octet-stream",
-        )
+    file_name = doc.file_name or f"{doc.file_unique_id}{suffix}"
+    mime = doc.mime_type or "application/octet-stream"
+    if (doc.file_size or 0) <= IN_MEMORY_UPLOAD_LIMIT:
+        buf = await file.download_as_bytearray()
+        res = await upload_bytes_to_backend(state, bytes(buf), file_name, mime)
+    else:
+        with tempfile.NamedTemporaryFile(delete=True, suffix=suffix) as tmp:
+            await file.download_to_drive(tmp.name)
+            res = await upload_file_to_backend(state, tmp.name, file_name, mime)
     if res.get("url"):
         state.setdefault("attachments", []).append(res["url"])
-        await answer(update, "📎 Fayl biriktirildi. Matn yuboring.", markup=get_main_menu())
+        await answer(update, "📎 Fayl biriktirildi. Matn yuboring.", markup=MAIN_MENU)
     elif res.get("limit"):
         await _send_upgrade_prompt(update, context, res.get("message"))
     else:
@@ -1360,156 +1765,389 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # --- Voice ---------------------------------------------------------------- #
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     state = await ensure_ready(update, context)
-    from io import BytesIO
-
     voice = update.message.voice
     await context.bot.send_chat_action(update.effective_chat.id, ChatAction.RECORD_VOICE)
 
     # Download voice
     tg_file = await context.bot.get_file(voice.file_id)
-    with tempfile.NamedTemporaryFile(delete=True, suffix=".ogg") as tmp:
-        await tg_file.download_to_drive(tmp.name)
-        try:
-            # 1) STT (OpenAI, Uzbek-first). The /voice/stt endpoint enforces the
-            #    user's voice-minutes limit server-side and returns 403 if exceeded.
-            with open(tmp.name, "rb") as f:
-                files = {"file": ("voice.ogg", f, "audio/ogg")}
-                stt_resp = await api_request("post", "/voice/stt", state, files=files)
-            transcript = (stt_resp.get("text") or "").strip()
-            if not transcript:
-                await update.message.reply_text("🎤 Ovoz aniqlanmadi, qayta urinib ko‘ring.")
+    audio = bytes(await tg_file.download_as_bytearray())
+    tts_task: Optional[asyncio.Task] = None
+    finished = False
+    try:
+        # 1) STT (OpenAI, Uzbek-first). The /voice/stt endpoint enforces the
+        #    user's voice-minutes limit server-side and returns 403 if exceeded.
+        files = {"file": ("voice.ogg", audio, "audio/ogg")}
+        stt_resp = await api_request("post", "/voice/stt", state, files=files)
+        transcript = (stt_resp.get("text") or "").strip()
+        if not transcript:
+            await answer(update, "🎤 Ovoz aniqlanmadi, qayta urinib ko‘ring.")
+            return
+
+        # 2) Chat (enforces the message limit server-side). TTS starts on the
+        #    "done" event while the final reply edit is still in flight.
+        async def _start_tts(reply: str) -> None:
+            nonlocal tts_task
+            if finished or tts_task is not None:
                 return
-            await update.message.reply_text(f"🎤 {transcript}")
+            tts_task = asyncio.create_task(
+                api_request("post", "/voice/tts", state, json_body={"text": reply}, expect_json=False)
+            )
 
-            # 2) Chat (enforces the message limit server-side)
-            reply_text = await handle_chat(update, context, transcript, return_reply=True)
+        # The echo is awaited first so it always sits above the reply; it is
+        # cosmetic, so a failure must not abort the reply.
+        try:
+            await telegram_call(
+                lambda: update.message.reply_text(f"🎤 {transcript}"), chat_id=update.effective_chat.id
+            )
+        except Exception as echo_exc:
+            logger.warning("Transcript echo failed: %s", echo_exc)
+        reply_text = await handle_chat(update, context, transcript, return_reply=True, on_done=_start_tts)
 
-            # 3) TTS reply (best-effort — voice output is a bonus)
-            if reply_text:
-                try:
-                    tts_resp = await api_request(
-                        "post",
-                        "/voice/tts",
-                        state,
-                        json_body={"text": reply_text},
-                        expect_json=False,
-                    )
-                    await update.message.reply_audio(
-                        audio=BytesIO(tts_resp.content),
+        # 3) TTS reply (best-effort — voice output is a bonus)
+        if reply_text:
+            try:
+                if tts_task is None:
+                    await _start_tts(reply_text)
+                tts_resp = await tts_task
+                await telegram_call(
+                    lambda: update.message.reply_audio(
+                        audio=tts_resp.content,
                         filename="salom-ai-reply.mp3",
                         caption="🔊 Javob (audio)",
-                    )
-                except Exception as tts_exc:
-                    logger.warning("TTS failed: %s", tts_exc)
-        except Exception as exc:
-            logger.exception("Voice handling failed: %s", exc)
-            # Surface friendly errors (e.g. rate-limit reached) instead of a generic one.
-            friendly = _extract_api_error(exc)
-            low = friendly.lower()
-            if any(w in low for w in ("limit", "tugadi", "yetdingiz", "tiklanadi")):
-                await answer(update, f"⚠️ {friendly}")
-            else:
-                await answer(update, "⚠️ Ovozli xabarni qayta ishlashda xatolik. Qaytadan urinib ko‘ring.")
+                    ),
+                    chat_id=update.effective_chat.id,
+                )
+            except Exception as tts_exc:
+                logger.warning("TTS failed: %s", tts_exc)
+    except Exception as exc:
+        logger.exception("Voice handling failed: %s", exc)
+        # Surface friendly errors (e.g. rate-limit reached) instead of a generic one.
+        friendly = _extract_api_error(exc)
+        low = friendly.lower()
+        if any(w in low for w in ("limit", "tugadi", "yetdingiz", "tiklanadi")):
+            await answer(update, f"⚠️ {friendly}")
+        else:
+            await answer(update, "⚠️ Ovozli xabarni qayta ishlashda xatolik. Qaytadan urinib ko‘ring.")
+    finally:
+        finished = True
+        if tts_task is not None and not tts_task.done():
+            tts_task.cancel()
 
 
 # --- Callback routing ------------------------------------------------------ #
+# Each handler receives the callback_data text after the first ":" ("" if none).
+async def _cb_conv(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    await set_conversation(update, context, int(arg))
+
+
+async def _cb_model(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    state = await ensure_ready(update, context)
+    state["model"] = arg
+    await answer(update, f"✅ Model tanlandi: {html.escape(arg)}", markup=MAIN_MENU)
+
+
+async def _cb_plan(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    fire(get_state(context), "paywall_plan_clicked", {"plan": arg})
+    await choose_payment_method(update, context, arg)
+
+
+async def _cb_pay_once(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    fire(get_state(context), "payment_started", {"plan": arg, "type": "one_time"})
+    await initiate_one_time_payment(update, context, arg)
+
+
+async def _cb_pay_auto(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    fire(get_state(context), "payment_started", {"plan": arg, "type": "auto"})
+    await initiate_payment(update, context, arg)
+
+
+async def _cb_pay_payme(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    fire(get_state(context), "payment_started", {"plan": arg, "provider": "payme"})
+    await initiate_payme_payment(update, context, arg)
+
+
+async def _cb_goto_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    fire(get_state(context), "paywall_shown", {"context": "bot"})
+    await handle_subscribe(update, context)
+
+
+async def _cb_toggle_renew(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    enabled = arg == "on"
+    state = await ensure_ready(update, context)
+    try:
+        await api_request("post", "/subscriptions/auto-renew", state, json_body={"enabled": enabled})
+        invalidate_user_cache(update.effective_user.id)
+        status = "yoqildi ✅" if enabled else "o'chirildi ❌"
+        await answer(update, f"🔄 Avtomatik yangilanish {status}", markup=MAIN_MENU)
+    except Exception as exc:
+        logger.warning("Toggle auto-renew failed: %s", exc)
+        await answer(update, "⚠️ Xatolik yuz berdi.", markup=MAIN_MENU)
+
+
+async def _cb_cancel_sub(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    state = await ensure_ready(update, context)
+    try:
+        resp = await api_request("post", "/subscriptions/cancel", state, json_body={})
+        invalidate_user_cache(update.effective_user.id)
+        expires = resp.get("expires_at", "")[:10] if resp.get("expires_at") else ""
+        await answer(
+            update,
+            f"✅ Avtomatik yangilanish o'chirildi.\nObuna {html.escape(expires)} gacha faol qoladi.",
+            markup=MAIN_MENU,
+            html_mode=True,
+        )
+    except Exception as exc:
+        logger.warning("Cancel sub failed: %s", exc)
+        await answer(update, "⚠️ Xatolik yuz berdi.", markup=MAIN_MENU)
+
+
+async def _cb_cancel_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    state = await ensure_ready(update, context)
+    state["input_mode"] = "chat"
+    state["pending_card_number"] = None
+    state["pending_request_id"] = None
+    state["pending_phone_hint"] = None
+    state["pending_plan_code"] = None
+    await answer(update, "❌ To'lov bekor qilindi.", markup=MAIN_MENU)
+
+
+async def _cb_retry_sms(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    state = await ensure_ready(update, context)
+    if state.get("pending_request_id"):
+        state["input_mode"] = "sms_code"
+        phone_hint = state.get("pending_phone_hint", "")
+        hint_text = f" ({phone_hint})" if phone_hint else ""
+        await answer(update, f"📱 SMS kodni qayta kiriting{hint_text}:")
+    else:
+        await answer(update, "⚠️ Sessiya tugadi. Qaytadan boshlang.", markup=MAIN_MENU)
+
+
+async def _cb_retry_card(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    state = await ensure_ready(update, context)
+    plan_code = state.get("pending_plan_code")
+    if plan_code:
+        state["input_mode"] = "chat"
+        state["pending_card_number"] = None
+        state["pending_request_id"] = None
+        await initiate_payment(update, context, plan_code)
+    else:
+        await answer(update, "⚠️ Sessiya tugadi. Qaytadan boshlang.", markup=MAIN_MENU)
+
+
+async def _cb_show_cards(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    await show_saved_cards(update, context)
+
+
+async def _cb_delete_card(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    card_id = int(arg)
+    state = await ensure_ready(update, context)
+    try:
+        await api_request("delete", f"/cards/{card_id}", state)
+        invalidate_user_cache(update.effective_user.id)
+        await answer(update, "✅ Karta o'chirildi.", markup=MAIN_MENU)
+    except Exception as exc:
+        logger.warning("Delete card failed: %s", exc)
+        await answer(update, "⚠️ Kartani o'chirishda xatolik.", markup=MAIN_MENU)
+
+
+async def _cb_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    await answer(update, "⚠️ Buyruq tanilmadi.", markup=MAIN_MENU)
+
+
+# Keyed by the callback_data prefix before ":" (or the whole value if it has none).
+_CB_HANDLERS: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE, str], Awaitable[None]]] = {
+    "conv": _cb_conv,
+    "model": _cb_model,
+    "plan": _cb_plan,
+    "pay_once": _cb_pay_once,
+    "pay_auto": _cb_pay_auto,
+    "pay_payme": _cb_pay_payme,
+    "goto_subscribe": _cb_goto_subscribe,
+    "toggle_renew": _cb_toggle_renew,
+    "cancel_sub": _cb_cancel_sub,
+    "cancel_payment": _cb_cancel_payment,
+    "retry_sms": _cb_retry_sms,
+    "retry_card": _cb_retry_card,
+    "show_cards": _cb_show_cards,
+    "delete_card": _cb_delete_card,
+}
+
+
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     if not query or not query.data:
         return
 
-    data = query.data
-    if data.startswith("conv:"):
-        conv_id = int(data.split(":", 1)[1])
-        await set_conversation(update, context, conv_id)
-    elif data.startswith("model:"):
-        model_id = data.split(":", 1)[1]
-        state = await ensure_ready(update, context)
-        state["model"] = model_id
-        await answer(update, f"✅ Model tanlandi: {html.escape(model_id)}", markup=get_main_menu())
-    elif data.startswith("plan:"):
-        plan_code = data.split(":", 1)[1]
-        fire(get_state(context), "paywall_plan_clicked", {"plan": plan_code})
-        await choose_payment_method(update, context, plan_code)
-    elif data.startswith("pay_once:"):
-        plan_code = data.split(":", 1)[1]
-        fire(get_state(context), "payment_started", {"plan": plan_code, "type": "one_time"})
-        await initiate_one_time_payment(update, context, plan_code)
-    elif data.startswith("pay_auto:"):
-        plan_code = data.split(":", 1)[1]
-        fire(get_state(context), "payment_started", {"plan": plan_code, "type": "auto"})
-        await initiate_payment(update, context, plan_code)
-    elif data.startswith("pay_payme:"):
-        plan_code = data.split(":", 1)[1]
-        fire(get_state(context), "payment_started", {"plan": plan_code, "provider": "payme"})
-        await initiate_payme_payment(update, context, plan_code)
-    elif data == "goto_subscribe":
-        fire(get_state(context), "paywall_shown", {"context": "bot"})
-        await handle_subscribe(update, context)
-    elif data.startswith("toggle_renew:"):
-        enabled = data.split(":", 1)[1] == "on"
-        state = await ensure_ready(update, context)
+    head, _, arg = query.data.partition(":")
+    await _CB_HANDLERS.get(head, _cb_unknown)(update, context, arg)
+
+
+# --- Persistence ----------------------------------------------------------- #
+class SQLitePersistence(BasePersistence):
+    """Store each user's data as its own JSON row in SQLite.
+
+    PTB only hands over the users touched since the last interval, so a flush
+    rewrites those rows instead of pickling every user's state at once. The
+    rows of one flush are written with a single executemany and commit. Only
+    user_data is persisted; the bot does not use chat/bot/callback data.
+    """
+
+    def __init__(self, db_path: str, legacy_pickle: Optional[str] = None, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.db_path = db_path
+        self.legacy_pickle = legacy_pickle
+        self._db: Optional[aiosqlite.Connection] = None
+        # Last JSON written per user. PTB marks a user dirty after every
+        # update, even read-only ones, so unchanged rows are skipped.
+        self._written: Dict[int, str] = {}
+        # Rows staged by update_user_data, the batch being written and the
+        # task writing them out.
+        self._pending: Dict[int, str] = {}
+        self._inflight: Dict[int, str] = {}
+        self._write_task: Optional[asyncio.Task] = None
+
+    async def _conn(self) -> aiosqlite.Connection:
+        if self._db is None:
+            self._db = await aiosqlite.connect(self.db_path)
+            await self._db.execute(
+                "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+            )
+            await self._db.commit()
+        return self._db
+
+    async def _import_legacy_pickle(self, db: aiosqlite.Connection) -> Dict[int, Dict[str, Any]]:
+        """Carry users over from the old PicklePersistence file on first start."""
+        if not self.legacy_pickle or not os.path.exists(self.legacy_pickle):
+            return {}
         try:
-            await api_request("post", "/subscriptions/auto-renew", state, json_body={"enabled": enabled})
-            status = "yoqildi ✅" if enabled else "o'chirildi ❌"
-            await answer(update, f"🔄 Avtomatik yangilanish {status}", markup=get_main_menu())
+            with open(self.legacy_pickle, "rb") as f:
+                user_data = pickle.load(f).get("user_data") or {}
         except Exception as exc:
-            logger.warning("Toggle auto-renew failed: %s", exc)
-            await answer(update, "⚠️ Xatolik yuz berdi.", markup=get_main_menu())
-    elif data == "cancel_sub":
-        state = await ensure_ready(update, context)
+            logger.warning("Could not import legacy state %s: %s", self.legacy_pickle, exc)
+            return {}
+        self._written = {user_id: json.dumps(data) for user_id, data in user_data.items()}
+        await db.executemany(
+            "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+            list(self._written.items()),
+        )
+        await db.commit()
+        logger.info("Imported %d users from %s", len(user_data), self.legacy_pickle)
+        return dict(user_data)
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        db = await self._conn()
+        async with db.execute("SELECT user_id, data FROM user_data") as cursor:
+            self._written = {user_id: data async for user_id, data in cursor}
+        if not self._written:
+            return await self._import_legacy_pickle(db)
+        return {user_id: json.loads(data) for user_id, data in self._written.items()}
+
+    async def _write_pending(self) -> None:
         try:
-            resp = await api_request("post", "/subscriptions/cancel", state, json_body={})
-            expires = resp.get("expires_at", "")[:10] if resp.get("expires_at") else ""
-            await answer(
-                update,
-                f"✅ Avtomatik yangilanish o'chirildi.\nObuna {html.escape(expires)} gacha faol qoladi.",
-                markup=get_main_menu(),
-                html_mode=True,
-            )
-        except Exception as exc:
-            logger.warning("Cancel sub failed: %s", exc)
-            await answer(update, "⚠️ Xatolik yuz berdi.", markup=get_main_menu())
-    elif data == "cancel_payment":
-        state = await ensure_ready(update, context)
-        state["input_mode"] = "chat"
-        state["pending_card_number"] = None
-        state["pending_request_id"] = None
-        state["pending_phone_hint"] = None
-        state["pending_plan_code"] = None
-        await answer(update, "❌ To'lov bekor qilindi.", markup=get_main_menu())
-    elif data == "retry_sms":
-        state = await ensure_ready(update, context)
-        if state.get("pending_request_id"):
-            state["input_mode"] = "sms_code"
-            phone_hint = state.get("pending_phone_hint", "")
-            hint_text = f" ({phone_hint})" if phone_hint else ""
-            await answer(update, f"📱 SMS kodni qayta kiriting{hint_text}:")
-        else:
-            await answer(update, "⚠️ Sessiya tugadi. Qaytadan boshlang.", markup=get_main_menu())
-    elif data == "retry_card":
-        state = await ensure_ready(update, context)
-        plan_code = state.get("pending_plan_code")
-        if plan_code:
-            state["input_mode"] = "chat"
-            state["pending_card_number"] = None
-            state["pending_request_id"] = None
-            await initiate_payment(update, context, plan_code)
+            # Loop so rows staged while a batch is being written go out too.
+            while self._pending:
+                self._inflight, self._pending = self._pending, {}
+                try:
+                    db = await self._conn()
+                    await db.executemany(
+                        "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                        list(self._inflight.items()),
+                    )
+                    await db.commit()
+                except Exception:
+                    # Re-stage the batch; the next update or flush() retries it.
+                    self._pending = {**self._inflight, **self._pending}
+                    raise
+                else:
+                    self._written.update(self._inflight)
+                finally:
+                    self._inflight = {}
+        finally:
+            self._write_task = None
+
+    def _schedule_writes(self) -> None:
+        if self._pending and self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_pending())
+
+    async def _wait_for_writes(self) -> None:
+        if self._write_task is not None:
+            # Shielded: several callers may await the same batch.
+            await asyncio.shield(self._write_task)
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        # PTB gathers these calls for all dirty users; each one only stages its
+        # row, and the first schedules the batch that writes all of them.
+        encoded = json.dumps(data)
+        # Compared with what is (or is being) stored, so a staged row left by a
+        # failed batch is still written even when the data hasn't changed since.
+        if self._inflight.get(user_id, self._written.get(user_id)) == encoded:
+            self._pending.pop(user_id, None)
         else:
-            await answer(update, "⚠️ Sessiya tugadi. Qaytadan boshlang.", markup=get_main_menu())
-    elif data == "show_cards":
-        await show_saved_cards(update, context)
-    elif data.startswith("delete_card:"):
-        card_id = int(data.split(":", 1)[1])
-        state = await ensure_ready(update, context)
+            self._pending[user_id] = encoded
+        self._schedule_writes()
+        await self._wait_for_writes()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending.pop(user_id, None)
+        await self._wait_for_writes()
+        self._written.pop(user_id, None)
+        db = await self._conn()
+        await db.execute("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+        await db.commit()
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        # The in-memory copy is authoritative; nothing else writes the DB.
+        pass
+
+    async def flush(self) -> None:
+        # A failed batch re-stages its rows, so one more pass writes them out.
+        with contextlib.suppress(Exception):
+            await self._wait_for_writes()
+        self._schedule_writes()
         try:
-            await api_request("delete", f"/cards/{card_id}", state)
-            await answer(update, "✅ Karta o'chirildi.", markup=get_main_menu())
+            await self._wait_for_writes()
         except Exception as exc:
-            logger.warning("Delete card failed: %s", exc)
-            await answer(update, "⚠️ Kartani o'chirishda xatolik.", markup=get_main_menu())
-    else:
-        await answer(update, "⚠️ Buyruq tanilmadi.", markup=get_main_menu())
+            logger.error("Could not persist %d users on shutdown: %s", len(self._pending), exc)
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    # Not stored (see store_data above); required by the BasePersistence interface.
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Any, Any]:
+        return {}
+
+    async def update_conversation(self, name: str, key: Any, new_state: Optional[object]) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
 
 
 # --- Application setup ----------------------------------------------------- #
@@ -1521,15 +2159,24 @@ async def post_init(application: Application) -> None:
         ("cards", "Saqlangan kartalar"),
     ]
     await application.bot.set_my_commands(commands)
+    if MODELS_CACHE_TTL > 0:
+        # Fill the shared model list before the first /start or model picker.
+        application.create_task(load_models({}))
+
+
+async def post_shutdown(application: Application) -> None:
+    await HTTP.aclose()
+    log_listener.stop()
 
 
 def main() -> None:
-    persistence = PicklePersistence(filepath=STATE_FILE)
+    persistence = SQLitePersistence(STATE_DB, legacy_pickle=STATE_FILE, update_interval=PERSISTENCE_INTERVAL)
     application = (
         Application.builder()
         .token(TELEGRAM_TOKEN)
         .persistence(persistence)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 